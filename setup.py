@@ -16,6 +16,9 @@ setuptools.setup(
         "Programming Language :: Python :: 3 :: Only"
     ),
     description="Streamly is a very simple yet powerful wrapper for streams.",
+    extras_require={
+        "numpy": ["numpy"]
+    },
     license="MIT",
     long_description=read_me,
     long_description_content_type="text/x-rst",
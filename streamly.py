@@ -3,13 +3,35 @@
 Include the following functionality during on the fly read operations:
 - Adjoining of multiple streams
 - Removal of header and footer data, identified by a value (e.g. byte string or string)
+- Skipping of preambles by line number or offset, seeking where the stream allows
 - Logging of read progress
 - Guaranteed read size (where the data is not yet exhausted)
 - Consistent API for streams returning byte strings or strings
+- Fanning out of read data to multiple sinks in a single pass
+- Splitting of read data into part files of whole rows, bounded by length or row count
+- Batches of whole rows with row and field offsets computed by NumPy (optional dependency)
+- Thread-safe distribution of whole rows to multiple consumers
+- Learning of header and footer positions for repeat layouts, skipping the search for them on subsequent reads
+- Counting and hashing of data, both kept and discarded, without a second pass
 """
 
 
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import io
+import json
 import logging
+import os
+import queue
+import shutil
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 # Singleton sentinel values for parameter defaults. Use class rather than object() so Sphinx documents correctly.
@@ -19,6 +41,11 @@ class _Sentinel:
 
 _EMPTY = _Sentinel()
 _LINE_FEED = _Sentinel()
+_STOP = _Sentinel()
+
+
+# The read size used when discarding a preamble of a known offset from a stream that cannot seek
+_PREAMBLE_READ_SIZE = 65536
 
 
 _logger = logging.getLogger(__name__)
@@ -40,6 +67,199 @@ class Stream:
         self.length = length
 
 
+def _find_nth(sequence, value, n, start=0):
+    # Like find but for the nth (non-overlapping) occurrence of value. Returns -1 if there are fewer occurrences.
+    index = sequence.find(value, start)
+    while n > 1 and index != -1:
+        index = sequence.find(value, index + len(value))
+        n -= 1
+    return index
+
+
+def _find_all(array, value):
+    # Vectorised equivalent of repeatedly calling find, returning the index of each non-overlapping occurrence.
+    value = numpy.frombuffer(value, dtype=numpy.uint8)
+    length = len(array) - len(value) + 1
+    if length <= 0:
+        return numpy.empty(0, dtype=numpy.intp)
+    mask = array[:length] == value[0]
+    for index in range(1, len(value)):
+        mask &= array[index:index + length] == value[index]
+    indexes = numpy.flatnonzero(mask)
+    if len(value) > 1 and (numpy.diff(indexes) < len(value)).any():
+        # Only a value that can overlap itself (e.g. b"\n\n") gets here. Drop each occurrence that starts before the
+        # previous one ends so that the offsets agree with find and count.
+        kept_indexes = []
+        next_start = 0
+        for index in indexes.tolist():
+            if index >= next_start:
+                kept_indexes.append(index)
+                next_start = index + len(value)
+        indexes = numpy.array(kept_indexes, dtype=numpy.intp)
+    return indexes
+
+
+class Batch(collections.namedtuple("Batch", ("data", "row_starts", "row_ends", "field_starts", "field_ends"))):
+    """Provide a batch of whole rows, as returned by :meth:`Streamly.iter_batches`.
+
+    All offsets are NumPy arrays of indexes into `data` so that rows and fields can be sliced without searching `data`
+    again.
+
+    :ivar bytes data: the rows.
+    :ivar row_starts: the offset at which each row starts.
+    :ivar row_ends: the offset at which each row ends, excluding the row end identifier.
+    :ivar field_starts: the offset at which each field of each row starts, in order. ``None`` if no delimiter is passed.
+    :ivar field_ends: the offset at which each field of each row ends, in order. ``None`` if no delimiter is passed.
+    """
+
+    __slots__ = ()
+
+
+class LayoutProfiles:
+    """Provide a cache of the positions of headers and footers in report layouts, for use with :class:`Streamly`.
+
+    Each profile is keyed by a report layout (e.g. a report type) and records the offset of the header row identifier
+    from the start of a stream and the offset of the footer identifier from the end of a stream. When the cache is full,
+    the least recently used profile is evicted.
+
+    :param str path: the path of a JSON file to load the profiles from, if it exists, and to save them to. Defaults to
+        ``None``, i.e. the profiles are not persisted.
+    :param int max_size: the maximum number of profiles to keep. Defaults to ``128``.
+
+    :ivar int max_size: see Parameters.
+    :ivar str path: see Parameters.
+    """
+
+    def __init__(self, path=None, max_size=128):
+        """Initialise the cache, loading any profiles persisted to path."""
+        self.path = path
+        self.max_size = max_size
+        self._profiles = collections.OrderedDict()
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, "rt", encoding="utf8") as fp:
+                for key, profile in json.load(fp):
+                    self._set(key, profile)
+
+    def __contains__(self, key):
+        return key in self._profiles
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def _set(self, key, profile):
+        self._profiles[key] = profile
+        self._profiles.move_to_end(key)
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+
+    def get(self, key):
+        """Return the profile for key, marking it as recently used.
+
+        :param str key: the report layout
+        :returns: a dict with ``"header_row_offset"`` and/or ``"footer_offset_from_end"`` items, or ``None`` if there is
+            no profile for key
+        """
+        profile = self._profiles.get(key)
+        if profile is not None:
+            self._profiles.move_to_end(key)
+        return profile
+
+    def save(self):
+        """Save the profiles to path, least recently used first so that the order survives a reload."""
+        if self.path is None:
+            raise ValueError("there is no path to save to")
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wt", encoding="utf8") as fp:
+            json.dump(list(self._profiles.items()), fp)
+        # Replace rather than write in place so a failed save does not lose the existing profiles
+        os.replace(temp_path, self.path)
+
+    def update(self, key, **items):
+        """Update the profile for key with items, creating it if necessary and marking it as recently used.
+
+        :param str key: the report layout
+        :param items: the offsets to record
+        """
+        profile = dict(self._profiles.get(key) or {})
+        profile.update(items)
+        self._set(key, profile)
+
+
+class Tally:
+    """Track the length, row count and digests of data as it is read.
+
+    Instances are created by :class:`Streamly` to account for the data it returns and the header and footer data it
+    discards.
+
+    :param row_end_identifier: the value that ends a row. If ``None``, rows are not counted.
+    :param hash_algorithms: the names of the :mod:`hashlib` algorithms to compute digests with.
+
+    :ivar dict digests: the hexadecimal digest of the data, keyed by algorithm name. Empty until the data is complete.
+    :ivar int length: the length of the data.
+    :ivar int rows: the number of row end identifiers in the data. ``None`` if rows are not counted.
+    """
+
+    def __init__(self, row_end_identifier=None, hash_algorithms=()):
+        """Initialise a tally with zero length and rows."""
+        self.digests = {}
+        self.length = 0
+        self.rows = None if row_end_identifier is None else 0
+        self._row_end_identifier = row_end_identifier
+        self._hashes = [(name, hashlib.new(name)) for name in hash_algorithms]
+        self._tail = None
+
+    def finalise(self):
+        """Compute the digests once all of the data has been accounted for."""
+        self.digests = {name: hash_.hexdigest() for name, hash_ in self._hashes}
+
+    def update(self, data, start=0, end=None):
+        """Account for the length and rows of data[start:end]. Hashing is separate so it can run in another thread.
+
+        :param data: the data
+        :param int start: the index to account from. Defaults to ``0``.
+        :param int end: the index to account up to. Defaults to ``None``, i.e. the end of data.
+        """
+        end = len(data) if end is None else end
+        if end <= start:
+            return
+        self.length += end - start
+        if self.rows is None:
+            return
+        self.rows += data.count(self._row_end_identifier, start, end)
+        overlap = len(self._row_end_identifier) - 1
+        if overlap:
+            # The row end identifier may start at the end of the previous update and end in this one. Neither part can
+            # contain the identifier in full so counting the join only finds the spanning occurrence.
+            if self._tail:
+                self.rows += (self._tail + data[start:start + overlap]).count(self._row_end_identifier)
+            self._tail = ((self._tail or data[:0]) + data[max(start, end - overlap):end])[-overlap:]
+
+    def update_hashes(self, data):
+        """Update the digests with data.
+
+        :param bytes data: the data
+        """
+        for _, hash_ in self._hashes:
+            hash_.update(data)
+
+
+class _HashThread(threading.Thread):
+    def __init__(self, max_pending):
+        super().__init__(daemon=True)
+        self.queue = queue.Queue(max_pending)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                self.queue.task_done()
+                break
+            tallies, data = item
+            for tally in tallies:
+                tally.update_hashes(data)
+            self.queue.task_done()
+
+
 class Streamly:
     """Provide a wrapper for streams (aka file-like objects).
 
@@ -59,10 +279,31 @@ class Streamly:
         footer.
     :param bool retain_first_header_row: whether or not the read method should retain the header row of the first
         stream. Headers are removed from the second stream onwards regardless.
-    :raises: ValueError if no streams are passed.
+    :param int header_row_offset: the offset at which the header row starts in each stream, relative to the stream's
+        position when it is first read. If the stream is binary and seekable (and rows are not being counted), it is
+        seeked past rather than read. Takes precedence over `header_row_identifier`. Defaults to ``None``.
+    :param int header_row_line: the zero-based line on which the header row starts in each stream, i.e. the number of
+        lines to skip, where lines end with `header_row_end_identifier`. Takes precedence over `header_row_identifier`.
+        Defaults to ``None``.
+    :param layout_profiles: a :class:`streamly.LayoutProfiles` object used to look up and record the positions of the
+        header row identifier and footer identifier. Each stream is checked for `header_row_identifier` at the recorded
+        offset and, if found, the search for it is skipped. Likewise, if the stream is binary and seekable and its length
+        is known, the stream is peeked at for `footer_identifier` at the recorded offset from its end and, if found,
+        the search for it is skipped. Positions found by searching are recorded as each stream ends. To persist them,
+        call :meth:`LayoutProfiles.save` once reading is complete. Defaults to ``None``.
+    :param layout_key: the key of the profile in `layout_profiles`, e.g. the report type. Defaults to ``None``.
+    :param bool count_rows: whether or not to count the rows in the returned and discarded data. Rows are delimited by
+        `header_row_end_identifier`. Defaults to ``False``.
+    :param hash_algorithms: the names of the :mod:`hashlib` algorithms to compute digests of the returned data with,
+        e.g. ``("md5", "sha256")``. Strings are hashed as UTF-8. Defaults to ``None``, i.e. no hashing.
+    :param bool hash_in_thread: whether or not to compute the digests in a background thread, overlapping hashing with
+        reading. Defaults to ``False``.
+    :raises: ValueError if no streams are passed, if both `header_row_offset` and `header_row_line` are passed or if
+        only one of `layout_profiles` and `layout_key` is passed.
 
     :ivar bool binary: see Parameters.
-    :ivar bool contains_header_row: ``True`` if `header_row_identifier` is not ``None``.
+    :ivar bool contains_header_row: ``True`` if `header_row_identifier`, `header_row_offset` or `header_row_line` is
+        not ``None``.
     :ivar bool contains_footer: ``True`` if `footer_identifier` is not ``None``.
     :ivar dict current_stream: The stream details that will be referenced on the next read operation.
     :ivar int current_stream_index: The index of the current stream that will be referenced on the next read operation.
@@ -70,11 +311,18 @@ class Streamly:
     :ivar footer_identifier: See Parameters.
     :ivar header_row_identifier: See Parameters.
     :ivar header_row_end_identifier: See Parameters.
+    :ivar int header_row_line: See Parameters.
+    :ivar int header_row_offset: See Parameters.
     :ivar bool is_first_stream: ``True`` if the current stream is the first stream.
     :ivar bool is_last_stream: ``True`` if the current stream is the last stream.
+    :ivar layout_key: See Parameters.
+    :ivar layout_profiles: See Parameters.
     :ivar bool retain_first_header_row: See Parameters.
     :ivar list streams: the list of streams passed on instantiation but as dicts with items that are used to track
-        progress.
+        progress. Each includes a ``"tallies"`` item, structured like `tallies` but for that stream alone.
+    :ivar dict tallies: :class:`streamly.Tally` objects for the ``"cleaned"`` data returned by read and the
+        ``"header"`` and ``"footer"`` data discarded, across all streams. Only discarded data that is read is
+        accounted for; any data after a footer is never read. Digests are populated once `end_reached` is ``True``.
     :ivar int total_length: The total length of all the streams. If any stream's length is unknown, this value will be
         ``None``.
     :ivar int total_length_read: The total length read across all the streams.
@@ -82,17 +330,19 @@ class Streamly:
     """
 
     def __init__(self, *streams, binary=True, header_row_identifier=_EMPTY, header_row_end_identifier=_LINE_FEED,
-                 footer_identifier=None, retain_first_header_row=True):
+                 footer_identifier=None, retain_first_header_row=True, header_row_offset=None, header_row_line=None,
+                 layout_profiles=None, layout_key=None, count_rows=False, hash_algorithms=None, hash_in_thread=False):
         """Initialise a Stream wrapper object with header and footer identifiers referenced in the read process."""
         if not streams:
             raise ValueError("there must be at least one stream")
-        self.streams = [{
-            "length_read": 0,
-            "stream": getattr(stream, "stream", stream),
-            "header_row_found": False,
-            "footer_found": False,
-            "length": getattr(stream, "length", None)
-        } for stream in streams]
+        if header_row_offset is not None and header_row_line is not None:
+            raise ValueError("header_row_offset and header_row_line cannot both be passed")
+        if (layout_profiles is None) != (layout_key is None):
+            raise ValueError("layout_profiles and layout_key must be passed together")
+        self.layout_profiles = layout_profiles
+        self.layout_key = layout_key
+        self.header_row_offset = header_row_offset
+        self.header_row_line = header_row_line
         self.binary = binary
         self._empty = b"" if self.binary else ""
         self.header_row_identifier = header_row_identifier if header_row_identifier is not _EMPTY else self._empty
@@ -100,9 +350,28 @@ class Streamly:
             self.header_row_end_identifier = b"\n" if self.binary else "\n"
         else:
             self.header_row_end_identifier = header_row_end_identifier
+        self._row_end_identifier = self.header_row_end_identifier if count_rows else None
+        self._hash_algorithms = tuple(hash_algorithms or ())
+        # Validate the algorithm names up front rather than on the first read
+        for name in self._hash_algorithms:
+            hashlib.new(name)
+        self._hash_thread = None
+        self._hash_in_thread = hash_in_thread
+        self.streams = [{
+            "length_read": 0,
+            "stream": getattr(stream, "stream", stream),
+            "header_row_found": False,
+            "footer_found": False,
+            "length": getattr(stream, "length", None),
+            "tallies": self._create_tallies(),
+            "header_row_identifier_offset": None,
+            "footer_offset": None
+        } for stream in streams]
+        self.tallies = self._create_tallies()
         self.footer_identifier = footer_identifier
         self.retain_first_header_row = retain_first_header_row
-        self.contains_header_row = self.header_row_identifier is not None
+        self.contains_header_row = (self.header_row_identifier is not None or self.header_row_offset is not None or
+                                    self.header_row_line is not None)
         self.contains_footer = self.footer_identifier is not None
         self.current_stream_index = 0
         self.total_streams = len(self.streams)
@@ -112,6 +381,11 @@ class Streamly:
         self._end_of_prev_read = self._empty
         self._data_read_ahead = self._empty
         self._data_backlog = self._empty
+        self._row_remainder = self._empty
+        self._pushback = self._empty
+        self._layout_header_checked = False
+        self._layout_footer_checked = False
+        self._layout_footer_position = None
 
     @property
     def current_stream(self):
@@ -148,13 +422,72 @@ class Streamly:
             return sequence, self._empty
         return sequence[:at_index], sequence[at_index:]
 
+    def _create_tallies(self):
+        return {
+            "cleaned": Tally(self._row_end_identifier, self._hash_algorithms),
+            "header": Tally(self._row_end_identifier),
+            "footer": Tally(self._row_end_identifier)
+        }
+
     def _end_stream(self):
         self.current_stream["stream"].close()
+        self._update_layout_profile()
+        self._pushback = self._empty
+        self._layout_header_checked = False
+        self._layout_footer_checked = False
+        self._layout_footer_position = None
+        # Any data read ahead will be returned from the backlog and so it belongs to the stream that is ending
+        self._tally("cleaned", self._data_read_ahead)
+        self._finalise_tallies(self.current_stream["tallies"])
         if self.is_last_stream:
             self.end_reached = True
+            self._finalise_tallies(self.tallies)
+            if self._hash_thread is not None:
+                self._hash_thread.queue.put(_STOP)
+                self._hash_thread.join()
+                self._hash_thread = None
         else:
             self.current_stream_index += 1
         self._data_backlog = self._data_read_ahead
+        # The data read ahead now belongs to the backlog and must not be processed again as part of the next stream
+        self._data_read_ahead = self._empty
+
+    def _finalise_tallies(self, tallies):
+        if self._hash_thread is not None:
+            # The digests cannot be read until the thread has caught up with all of the data queued so far
+            self._hash_thread.queue.join()
+        for tally in tallies.values():
+            tally.finalise()
+
+    def _check_layout_footer(self):
+        # Peek at the position that the profile predicts for the footer, restoring the stream's position afterwards.
+        # The profile is only trusted, and the search for the footer skipped, if the footer is found there.
+        # Save current_stream so property does not need to be evaluated more than once
+        current_stream = self.current_stream
+        self._layout_footer_checked = True
+        if self.layout_profiles is None or current_stream["length"] is None:
+            return
+        profile = self.layout_profiles.get(self.layout_key)
+        if profile is None or profile.get("footer_offset_from_end") is None:
+            return
+        stream = current_stream["stream"]
+        seekable = getattr(stream, "seekable", None)
+        if not self.binary or seekable is None or not seekable():
+            return
+        footer_position = current_stream["length"] - profile["footer_offset_from_end"]
+        # Offset from the stream's actual position, which is beyond any data that has been pushed back
+        offset = footer_position - current_stream["length_read"]
+        if offset < 0:
+            return
+        position = stream.tell()
+        stream.seek(offset, io.SEEK_CUR)
+        footer_found = stream.read(len(self.footer_identifier)) == self.footer_identifier
+        stream.seek(position)
+        if not footer_found:
+            _logger.debug("Footer not found at profiled offset. Falling back to searching.")
+            return
+        _logger.debug("Footer found at profiled offset.")
+        self._layout_footer_position = footer_position
 
     def _footer_check_needed(self):
         return self.contains_footer and not self.current_stream["footer_found"]
@@ -177,9 +510,21 @@ class Streamly:
             _logger.info("Overall Progress: %s/%s (%s%%)", self.total_length_read, self.total_length or "?",
                          total_progress)
 
+    def _layout_header_check_needed(self):
+        return (self.layout_profiles is not None and bool(self.header_row_identifier) and
+                not self._layout_header_checked and not self.current_stream["header_row_found"])
+
+    def _preamble_skip_needed(self):
+        return ((self.header_row_offset is not None or self.header_row_line is not None) and
+                not self.current_stream["header_row_found"])
+
     def _read(self, size):
         if size <= 0:
             return self._empty
+        if self._pushback:
+            # Data that was read but then pushed back has already been accounted for
+            data, self._pushback = self._chop(self._pushback, size)
+            return data
         # Save current_stream so property does not need to be evaluated more than once
         current_stream = self.current_stream
         data = current_stream["stream"].read(size)
@@ -188,7 +533,18 @@ class Streamly:
         return data
 
     def _remove_footer(self, raw_data):
-        index = raw_data.find(self.footer_identifier)
+        if not self._layout_footer_checked:
+            self._check_layout_footer()
+        if self._layout_footer_position is None:
+            index = raw_data.find(self.footer_identifier)
+        else:
+            index = self._layout_footer_position - (self._stream_position() - len(raw_data))
+            if index >= len(raw_data):
+                # The footer has been verified to start beyond raw_data
+                return raw_data
+            # Read the rest of the footer identifier if it extends beyond raw_data, so that it is discarded with the
+            # footer rather than returned on the next read.
+            raw_data += self._read(index + len(self.footer_identifier) - len(raw_data))
         if index == -1:
             footer_identifier_length = len(self.footer_identifier)
             if footer_identifier_length > 1:
@@ -201,6 +557,8 @@ class Streamly:
             if index == -1:
                 return raw_data
         self.current_stream["footer_found"] = True
+        self.current_stream["footer_offset"] = self._stream_position() - len(raw_data) + index
+        self._tally("footer", raw_data, index)
         # On the off chance that the footer starts exactly at the start of raw_data, then we already have all the data
         # we want and so we should return an empty byte string (or empty string).
         return self._empty if index == 0 else raw_data[:index]
@@ -217,6 +575,7 @@ class Streamly:
                 # read's search for the header.
                 return self._calc_end_of_prev_read(raw_data, self.header_row_identifier), self._empty
             current_stream["header_row_found"] = True
+            current_stream["header_row_identifier_offset"] = self._stream_position() - len(raw_data) + index
             # Add the length of the header_row_identifier to get the index where the header row actually starts. This
             # has the nice property of being 0 if the header row identifier was an empty string (i.e. start of stream)
             index += len(self.header_row_identifier)
@@ -240,6 +599,148 @@ class Streamly:
         # the list is an unnecessary expense.
         return self._empty, raw_data if index == 0 else raw_data[index:]
 
+    def _seek_layout_header(self):
+        # Save current_stream so property does not need to be evaluated more than once
+        current_stream = self.current_stream
+        self._layout_header_checked = True
+        profile = self.layout_profiles.get(self.layout_key)
+        if profile is None or profile.get("header_row_offset") is None:
+            return
+        offset = profile["header_row_offset"] - self._stream_position()
+        identifier = self.header_row_identifier
+        if offset < 0:
+            return
+        stream = current_stream["stream"]
+        seekable = getattr(stream, "seekable", None)
+        if self.binary and self._row_end_identifier is None and seekable is not None and seekable():
+            position = stream.tell()
+            stream.seek(offset, io.SEEK_CUR)
+            if stream.read(len(identifier)) != identifier:
+                _logger.debug("Header row identifier not found at profiled offset. Falling back to searching.")
+                stream.seek(position)
+                return
+            current_stream["length_read"] += offset + len(identifier)
+            current_stream["tallies"]["header"].length += offset + len(identifier)
+            self.tallies["header"].length += offset + len(identifier)
+        else:
+            # Stream towards the offset rather than holding the preamble. Each chunk is searched on the way so that if the
+            # identifier is found any earlier than predicted, the fallback still finds it.
+            remaining = offset + len(identifier)
+            overlap = len(identifier) - 1
+            data = self._empty
+            index = -1
+            while remaining:
+                chunk = self._read(min(remaining, _PREAMBLE_READ_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                # Only the tail of the previous data remains, in case the identifier spans the two
+                data += chunk
+                index = data.find(identifier)
+                if index != -1:
+                    break
+                self._tally("header", data, 0, len(data) - overlap)
+                data = data[len(data) - overlap:]
+            # The data read ends where the identifier should so that is the only place the first occurrence can be
+            if remaining or index == -1 or index != len(data) - len(identifier):
+                _logger.debug("Header row identifier not found at profiled offset. Falling back to searching.")
+                if index != -1:
+                    self._tally("header", data, 0, index)
+                    data = data[index:]
+                # Push back what has not been searched (or the identifier that was found early) so that subsequent
+                # reads search it
+                self._pushback = data + self._pushback
+                return
+            self._tally("header", data)
+        _logger.debug("Header row identifier found at profiled offset.")
+        current_stream["header_row_found"] = True
+        current_stream["header_row_identifier_offset"] = profile["header_row_offset"]
+        # The header row itself is removed by _remove_header, exactly as if it had been found by searching
+        self._seeking_header_row_end = not self.is_first_stream or not self.retain_first_header_row
+
+    def _skip_preamble(self, size):
+        # Save current_stream so property does not need to be evaluated more than once
+        current_stream = self.current_stream
+        if self.header_row_line is None:
+            remaining = self.header_row_offset
+            stream = current_stream["stream"]
+            seekable = getattr(stream, "seekable", None)
+            # Text streams only support seeking to opaque positions returned by tell and if rows are being counted, the
+            # preamble must be read anyway.
+            if remaining and self.binary and self._row_end_identifier is None and seekable is not None and seekable():
+                _logger.debug("Seeking past preamble...")
+                stream.seek(remaining, io.SEEK_CUR)
+                current_stream["length_read"] += remaining
+                current_stream["tallies"]["header"].length += remaining
+                self.tallies["header"].length += remaining
+                remaining = 0
+            while remaining:
+                data = self._read(min(remaining, _PREAMBLE_READ_SIZE))
+                if not data:
+                    return self._empty
+                self._tally("header", data)
+                remaining -= len(data)
+            leftover = self._empty
+        else:
+            remaining = self.header_row_line
+            identifier = self.header_row_end_identifier
+            end_of_prev_read = self._empty
+            leftover = self._empty
+            while remaining:
+                data = self._read(size)
+                if not data:
+                    return self._empty
+                # Prefix the end of the previous read in case the line end identifier spans the two reads
+                data = end_of_prev_read + data
+                count = data.count(identifier)
+                if count < remaining:
+                    remaining -= count
+                    self._tally("header", data, len(end_of_prev_read))
+                    end_of_prev_read = self._calc_end_of_prev_read(data, identifier)
+                    continue
+                index = _find_nth(data, identifier, remaining) + len(identifier)
+                self._tally("header", data, len(end_of_prev_read), index)
+                leftover = data[index:]
+                remaining = 0
+        current_stream["header_row_found"] = True
+        # The header row itself is removed by _remove_header, exactly as if it had been found by header_row_identifier
+        self._seeking_header_row_end = not self.is_first_stream or not self.retain_first_header_row
+        return leftover
+
+    def _stream_position(self):
+        # The position in the current stream that the next read will return data from
+        return self.current_stream["length_read"] - len(self._pushback)
+
+    def _update_layout_profile(self):
+        # Save current_stream so property does not need to be evaluated more than once
+        current_stream = self.current_stream
+        if self.layout_profiles is None:
+            return
+        items = {}
+        if current_stream["header_row_identifier_offset"] is not None:
+            items["header_row_offset"] = current_stream["header_row_identifier_offset"]
+        if current_stream["footer_offset"] is not None and current_stream["length"] is not None:
+            items["footer_offset_from_end"] = current_stream["length"] - current_stream["footer_offset"]
+        if items:
+            self.layout_profiles.update(self.layout_key, **items)
+
+    def _tally(self, region, data, start=0, end=None):
+        tallies = (self.current_stream["tallies"][region], self.tallies[region])
+        for tally in tallies:
+            tally.update(data, start, end)
+        if region != "cleaned" or not self._hash_algorithms or not data:
+            return
+        if not self.binary:
+            data = data.encode("utf8")
+        if not self._hash_in_thread:
+            for tally in tallies:
+                tally.update_hashes(data)
+            return
+        if self._hash_thread is None:
+            self._hash_thread = _HashThread(16)
+            self._hash_thread.start()
+        self._hash_thread.queue.put((tallies, data))
+
     def read(self, size=8192):
         """Read incrementally from the underlying streams.
 
@@ -278,7 +779,16 @@ class Streamly:
                 continue
             else:
                 _logger.debug("Reading data from the underlying stream...")
-                raw_data = self._read(size_remaining - len(self._data_read_ahead))
+                if self._preamble_skip_needed():
+                    _logger.debug("Skipping preamble...")
+                    raw_data = self._skip_preamble(size_remaining - len(self._data_read_ahead))
+                    raw_data += self._read(size_remaining - len(self._data_read_ahead) - len(raw_data))
+                elif self._layout_header_check_needed():
+                    _logger.debug("Checking for header at profiled offset...")
+                    self._seek_layout_header()
+                    raw_data = self._read(size_remaining - len(self._data_read_ahead))
+                else:
+                    raw_data = self._read(size_remaining - len(self._data_read_ahead))
                 if not raw_data and not self._data_read_ahead:
                     _logger.debug("Underlying stream returned no data.")
                     self._end_stream()
@@ -286,7 +796,10 @@ class Streamly:
                 else:
                     if self._header_check_needed():
                         _logger.debug("Looking for header...")
-                        self._end_of_prev_read, processed_data = self._remove_header(self._end_of_prev_read + raw_data)
+                        raw_data = self._end_of_prev_read + raw_data
+                        self._end_of_prev_read, processed_data = self._remove_header(raw_data)
+                        self._tally("header", raw_data, 0,
+                                    len(raw_data) - len(self._end_of_prev_read) - len(processed_data))
                     else:
                         processed_data = raw_data
                     # Don't look for the footer unless the header is found. Can't do an else if as the header may have
@@ -295,6 +808,363 @@ class Streamly:
                         _logger.debug("Looking for footer...")
                         processed_data = self._remove_footer(self._data_read_ahead + processed_data)
                     processed_data, self._data_read_ahead = self._chop(processed_data, size_remaining)
+                    self._tally("cleaned", processed_data)
             total_size += len(processed_data)
             data_to_return += processed_data
         return data_to_return
+
+    def read_rows(self, size=8192):
+        """Read whole rows incrementally from the underlying streams.
+
+        Read as per :meth:`read` but cut the data after the last `header_row_end_identifier` within it. The partial row
+        that follows is returned at the start of the subsequent read. If a single row is longer than size, reading
+        continues until the row ends. Once the underlying streams are exhausted, a final row that does not end with
+        `header_row_end_identifier` is returned as-is. Calls to this method should not be mixed with calls to read.
+
+        :param int size: the length to read from the underlying streams
+        :returns: either a byte string or string depending on what the underlying streams return when read
+        """
+        identifier = self.header_row_end_identifier
+        data = self._row_remainder + self.read(size)
+        index = data.rfind(identifier)
+        while index == -1:
+            more_data = self.read(size)
+            if not more_data:
+                self._row_remainder = self._empty
+                return data
+            # Only search the new data, plus enough of the old data to catch an identifier spanning the two
+            search_start = max(len(data) - len(identifier) + 1, 0)
+            data += more_data
+            index = data.rfind(identifier, search_start)
+        data, self._row_remainder = self._chop(data, index + len(identifier))
+        return data
+
+    def iter_batches(self, size=8192, delimiter=None):
+        """Iterate over batches of whole rows with precomputed row (and optionally field) offsets.
+
+        Read as per :meth:`read_rows`, locating the rows, and the fields within them, with vectorised NumPy operations.
+        Requires NumPy and that the underlying streams return bytes. Calls to this method should not be mixed with calls
+        to read or read_rows.
+
+        :param int size: the length to read from the underlying streams for each batch
+        :param bytes delimiter: the value that separates fields within a row. Defaults to ``None``, i.e. no field offsets.
+        :returns: an iterator of :class:`streamly.Batch` objects
+        :raises: ImportError if NumPy is not installed. ValueError if `binary` is ``False``.
+        """
+        if numpy is None:
+            raise ImportError("iter_batches requires numpy")
+        if not self.binary:
+            raise ValueError("iter_batches requires the underlying streams to return bytes")
+        identifier = self.header_row_end_identifier
+        data = self.read_rows(size)
+        while data:
+            array = numpy.frombuffer(data, dtype=numpy.uint8)
+            row_ends = _find_all(array, identifier)
+            if not data.endswith(identifier):
+                # The final row of the final stream may not be terminated
+                row_ends = numpy.append(row_ends, len(data))
+            row_starts = numpy.empty_like(row_ends)
+            row_starts[0] = 0
+            row_starts[1:] = row_ends[:-1] + len(identifier)
+            field_starts = field_ends = None
+            if delimiter is not None:
+                delimiters = _find_all(array, delimiter)
+                # Each row starts a field and each delimiter ends one field and starts the next. Rows do not overlap so
+                # sorting pairs every start with its end.
+                field_starts = numpy.sort(numpy.concatenate((row_starts, delimiters + len(delimiter))))
+                field_ends = numpy.sort(numpy.concatenate((delimiters, row_ends)))
+            yield Batch(data, row_starts, row_ends, field_starts, field_ends)
+            data = self.read_rows(size)
+
+
+class ConcurrentReader:
+    """Provide thread-safe access to a :class:`Streamly` object so that multiple threads can share its data.
+
+    Each call to :meth:`next_chunk` returns a distinct unit of whole rows, as per :meth:`Streamly.read_rows`, along with
+    its sequence number. Reads from the underlying streams are serialised whilst the consumers process their units
+    concurrently. The :class:`Streamly` object should not be read from directly once wrapped. If the consumers stop
+    before the data is exhausted, :meth:`close` should be called.
+
+    :param wrapped_stream: the :class:`Streamly` object to read from.
+    :param int size: the length to read from the underlying streams for each unit. Defaults to ``8192``.
+    :param int prefetch: the number of units to read ahead in a background thread, so that reading overlaps with the
+        consumers' processing. Defaults to ``0``, i.e. each unit is read by the consumer that requests it.
+
+    :ivar int size: see Parameters.
+    :ivar wrapped_stream: see Parameters.
+    """
+
+    def __init__(self, wrapped_stream, size=8192, prefetch=0):
+        """Initialise a concurrent reader. The prefetch thread, if needed, is started by the first call to next_chunk."""
+        self.wrapped_stream = wrapped_stream
+        self.size = size
+        self._closed = False
+        self._lock = threading.Lock()
+        self._sequence_number = 0
+        self._queue = queue.Queue(prefetch) if prefetch else None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def __iter__(self):
+        chunk = self.next_chunk()
+        while chunk is not None:
+            yield chunk
+            chunk = self.next_chunk()
+
+    def _next_chunk(self):
+        with self._lock:
+            if self._closed:
+                return None
+            data = self.wrapped_stream.read_rows(self.size)
+            if not data:
+                return None
+            sequence_number = self._sequence_number
+            self._sequence_number += 1
+        return sequence_number, data
+
+    def _prefetch(self):
+        try:
+            chunk = self._next_chunk()
+            while chunk is not None:
+                self._queue.put(chunk)
+                chunk = self._next_chunk()
+        except Exception as e:  # pylint: disable=broad-except
+            self._queue.put(e)
+            return
+        self._queue.put(_STOP)
+
+    def close(self):
+        """Stop reading, stopping the prefetch thread if it is running, and close the underlying streams."""
+        with self._lock:
+            self._closed = True
+        if self._thread is not None:
+            # Keep the queue drained so that the prefetch thread is never left blocked on a put
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+            self._thread.join()
+            # Release any consumers waiting on the queue. If the queue is full, it already holds the item that the
+            # thread finished with, which releases them just the same.
+            try:
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                pass
+        for stream in self.wrapped_stream.streams:
+            stream["stream"].close()
+
+    def next_chunk(self):
+        """Return the next unit of work.
+
+        :returns: a tuple of the zero-based sequence number and the data, or ``None`` once the data is exhausted or the
+            reader is closed
+        :raises: any exception raised whilst reading
+        """
+        if self._queue is None:
+            return self._next_chunk()
+        with self._thread_lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._prefetch, daemon=True)
+                self._thread.start()
+        if self._closed:
+            return None
+        chunk = self._queue.get()
+        if chunk is _STOP or isinstance(chunk, Exception):
+            # Put the item back for any other consumer waiting on the queue
+            self._queue.put(chunk)
+            if chunk is _STOP:
+                return None
+            raise chunk
+        return chunk
+
+
+class _SinkThread(threading.Thread):
+    def __init__(self, write, max_pending):
+        super().__init__(daemon=True)
+        self.exception = None
+        self.queue = queue.Queue(max_pending)
+        self._write = write
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is _STOP:
+                break
+            # Once the sink has failed, keep draining the queue so that the reading thread never blocks on a put that
+            # will not be consumed. The exception is raised to the caller from the reading thread.
+            if self.exception is None:
+                try:
+                    self._write(data)
+                except Exception as e:  # pylint: disable=broad-except
+                    self.exception = e
+
+
+def _get_write(sink):
+    return getattr(sink, "write", sink)
+
+
+def tee(wrapped_stream, *sinks, size=8192, threaded=False, max_pending=16):
+    """Read a :class:`Streamly` object once, delivering each chunk of data to multiple sinks.
+
+    :param wrapped_stream: the :class:`Streamly` object to read from.
+    :param sinks: one or more sinks. Each sink can either be an object that implements a write method (e.g. a file
+        object) or a callable that accepts the data as its only argument.
+    :param int size: the length to read on each read operation. Defaults to ``8192``.
+    :param bool threaded: whether or not each sink should be written to from its own thread. Defaults to ``False``,
+        i.e. each sink is written to in turn by the calling thread.
+    :param int max_pending: when `threaded` is ``True``, the maximum number of chunks that can be waiting on any one
+        sink. Once a sink falls this far behind, reading is paused until it catches up, bounding memory usage. Defaults
+        to ``16``.
+    :returns: the total length read
+    :raises: ValueError if no sinks are passed. Any exception raised by a sink is re-raised once reading has stopped.
+    """
+    if not sinks:
+        raise ValueError("there must be at least one sink")
+    total_length = 0
+    if not threaded:
+        writes = [_get_write(sink) for sink in sinks]
+        data = wrapped_stream.read(size)
+        while data:
+            for write in writes:
+                write(data)
+            total_length += len(data)
+            data = wrapped_stream.read(size)
+        return total_length
+    threads = [_SinkThread(_get_write(sink), max_pending) for sink in sinks]
+    for thread in threads:
+        thread.start()
+    try:
+        data = wrapped_stream.read(size)
+        while data:
+            for thread in threads:
+                if thread.exception is not None:
+                    raise thread.exception
+                # Blocks whilst the sink's queue is full, throttling the read to the pace of the slowest sink.
+                thread.queue.put(data)
+            total_length += len(data)
+            data = wrapped_stream.read(size)
+    finally:
+        for thread in threads:
+            thread.queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+    for thread in threads:
+        if thread.exception is not None:
+            raise thread.exception
+    return total_length
+
+
+def _compress_part(path):
+    compressed_path = path + ".gz"
+    with open(path, "rb") as source, gzip.open(compressed_path, "wb") as target:
+        shutil.copyfileobj(source, target)
+    os.remove(path)
+    return os.path.getsize(compressed_path)
+
+
+def write_parts(wrapped_stream, path_format, max_length=None, max_rows=None, repeat_header_row=False, compress=False,
+                workers=4, size=8192):
+    """Read a :class:`Streamly` object once, writing the data to multiple part files made up of whole rows.
+
+    Rows are delimited by the `header_row_end_identifier` of `wrapped_stream`.
+
+    :param wrapped_stream: the :class:`Streamly` object to read from.
+    :param str path_format: the path of each part, formatted with the zero-based index of the part, e.g.
+        ``"output/part-{index:05d}.csv"``.
+    :param int max_length: the maximum length of each part. A part only exceeds this if it is made up of a single row
+        that does. Defaults to ``None``, i.e. no limit.
+    :param int max_rows: the maximum number of rows in each part, excluding any repeated header row. Defaults to
+        ``None``, i.e. no limit.
+    :param bool repeat_header_row: whether or not the header row retained from the first stream (i.e. the first row
+        read) should be written at the start of every part. Defaults to ``False``.
+    :param bool compress: whether or not each part should be gzipped once it is written. Compression runs in a pool of
+        worker threads whilst reading continues. The path of a compressed part has ``".gz"`` appended and the
+        uncompressed part is removed. Defaults to ``False``.
+    :param int workers: the number of worker threads used for compression. Defaults to ``4``.
+    :param int size: the length to read on each read operation. Defaults to ``8192``.
+    :returns: a list of dicts, one per part, with the following items: ``"path"``; ``"offset"``, the offset of the part's
+        rows within the data read; ``"length"``, the length of the part, including any repeated header row;
+        ``"rows"``, the number of rows in the part, excluding any repeated header row; and, if compressing,
+        ``"compressed_length"``.
+    :raises: ValueError if neither `max_length` nor `max_rows` is passed or if `repeat_header_row` is ``True`` but
+        `wrapped_stream` does not retain a header row.
+    """
+    if max_length is None and max_rows is None:
+        raise ValueError("at least one of max_length and max_rows must be passed")
+    if repeat_header_row and not (wrapped_stream.contains_header_row and wrapped_stream.retain_first_header_row):
+        raise ValueError("repeat_header_row requires wrapped_stream to retain the first header row")
+    identifier = wrapped_stream.header_row_end_identifier
+    mode = "wb" if wrapped_stream.binary else "wt"
+    # Avoid newline translation so that the lengths in the manifest match the data read
+    open_kwargs = {} if wrapped_stream.binary else {"encoding": "utf8", "newline": ""}
+    manifest = []
+    futures = []
+    header_row = None
+    part = None
+    fp = None
+    offset = 0
+    executor = concurrent.futures.ThreadPoolExecutor(workers) if compress else None
+
+    def close_part():
+        fp.close()
+        if compress:
+            futures.append((part, executor.submit(_compress_part, part["path"])))
+        manifest.append(part)
+
+    try:
+        data = wrapped_stream.read_rows(size)
+        if repeat_header_row and data:
+            index = data.find(identifier)
+            index = len(data) if index == -1 else index + len(identifier)
+            header_row, data = data[:index], data[index:]
+            offset = len(header_row)
+        while True:
+            if not data:
+                data = wrapped_stream.read_rows(size)
+                if not data:
+                    break
+            if part is None:
+                part = {"path": path_format.format(index=len(manifest)), "offset": offset, "length": 0, "rows": 0}
+                _logger.info("Writing Part %s: %s", len(manifest) + 1, part["path"])
+                fp = open(part["path"], mode, **open_kwargs)
+                if header_row:
+                    fp.write(header_row)
+                    part["length"] += len(header_row)
+            cut = len(data)
+            if max_rows is not None:
+                index = _find_nth(data, identifier, max_rows - part["rows"])
+                if index != -1:
+                    cut = index + len(identifier)
+            if max_length is not None and part["length"] + cut > max_length:
+                index = data.rfind(identifier, 0, max(max_length - part["length"], 0))
+                if index != -1:
+                    cut = index + len(identifier)
+                elif part["rows"]:
+                    cut = 0
+                else:
+                    # Not even one row fits so write the row on its own rather than not at all
+                    index = data.find(identifier)
+                    cut = len(data) if index == -1 else index + len(identifier)
+            if cut:
+                part_data, data = data[:cut], data[cut:]
+                fp.write(part_data)
+                part["length"] += len(part_data)
+                part["rows"] += part_data.count(identifier) + (not part_data.endswith(identifier))
+                offset += len(part_data)
+            if (not cut or part["rows"] == max_rows or
+                    (max_length is not None and part["length"] >= max_length)):
+                close_part()
+                fp = part = None
+        if part is not None:
+            close_part()
+            fp = None
+        for part, future in futures:
+            part["compressed_length"] = future.result()
+            part["path"] += ".gz"
+    finally:
+        if fp is not None:
+            fp.close()
+        if executor is not None:
+            executor.shutdown()
+    return manifest
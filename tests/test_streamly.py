@@ -1,5 +1,9 @@
+import gzip
+import hashlib
 import io
 import logging
+import os
+import threading
 
 import pytest
 
@@ -65,6 +69,25 @@ def _general_text_stream():
     return io.StringIO(_general_test_data.decode(encoding="utf8"))
 
 
+class _NonSeekableStream(object):
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, size):
+        return self._stream.read(size)
+
+    def close(self):
+        self._stream.close()
+
+
+def _read_all(wrapped_stream, size):
+    output = data = wrapped_stream.read(size)
+    while data:
+        data = wrapped_stream.read(size)
+        output += data
+    return output
+
+
 def test_stream():
     string_io = io.StringIO()
     stream = streamly.Stream(string_io, 100)
@@ -72,6 +95,177 @@ def test_stream():
     assert stream.length == 100
 
 
+@pytest.mark.parametrize("prefetch", (0, 2))
+def test_concurrent_reader(prefetch):
+    wrapped_stream = streamly.Streamly(_general_byte_stream(), _general_byte_stream(),
+                                       header_row_identifier=b"Report Fields:\n", footer_identifier=b"Grand")
+    concurrent_reader = streamly.ConcurrentReader(wrapped_stream, size=5, prefetch=prefetch)
+    chunks = []
+
+    def consume():
+        for chunk in concurrent_reader:
+            chunks.append(chunk)
+
+    threads = [threading.Thread(target=consume) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    chunks.sort()
+    assert [sequence_number for sequence_number, _ in chunks] == list(range(len(chunks)))
+    assert all(data.endswith(b"\n") for _, data in chunks)
+    assert b"".join(data for _, data in chunks) == _data_body + _data_body[_data_body.find(b"START"):]
+    assert concurrent_reader.next_chunk() is None
+
+
+@pytest.mark.parametrize("prefetch", (0, 1))
+def test_concurrent_reader_close(prefetch):
+    raw_stream = io.BytesIO(b"a\n" * 100)
+    concurrent_reader = streamly.ConcurrentReader(streamly.Streamly(raw_stream), size=2, prefetch=prefetch)
+    assert raw_stream.tell() == 0
+    assert concurrent_reader.next_chunk() == (0, b"a\n")
+    concurrent_reader.close()
+    assert raw_stream.closed
+    assert concurrent_reader.next_chunk() is None
+
+
+@pytest.mark.parametrize("prefetch", (0, 1))
+def test_concurrent_reader_close_exhausted(prefetch):
+    raw_stream = io.BytesIO(b"a\n" * 10)
+    concurrent_reader = streamly.ConcurrentReader(streamly.Streamly(raw_stream), size=2, prefetch=prefetch)
+    assert len(list(concurrent_reader)) == 10
+    concurrent_reader.close()
+    assert concurrent_reader.next_chunk() is None
+
+
+def test_concurrent_reader_exception():
+    class FailingStream(object):
+        def read(self, size):
+            raise IOError("read failed")
+
+        def close(self):
+            pass
+
+    concurrent_reader = streamly.ConcurrentReader(streamly.Streamly(FailingStream()), prefetch=1)
+    for _ in range(2):
+        with pytest.raises(IOError):
+            concurrent_reader.next_chunk()
+    concurrent_reader.close()
+    assert concurrent_reader.next_chunk() is None
+
+
+def test_layout_profiles(tmpdir):
+    path = os.path.join(str(tmpdir), "profiles.json")
+    layout_profiles = streamly.LayoutProfiles(path, max_size=2)
+    assert layout_profiles.get("a") is None
+    layout_profiles.update("a", header_row_offset=1)
+    layout_profiles.update("b", header_row_offset=2)
+    layout_profiles.update("a", footer_offset_from_end=3)
+    layout_profiles.update("c", header_row_offset=4)
+    assert len(layout_profiles) == 2
+    assert "b" not in layout_profiles
+    assert layout_profiles.get("a") == {"header_row_offset": 1, "footer_offset_from_end": 3}
+    layout_profiles.save()
+    layout_profiles = streamly.LayoutProfiles(path, max_size=2)
+    layout_profiles.update("d", header_row_offset=5)
+    assert "a" in layout_profiles
+    assert "c" not in layout_profiles
+
+    with pytest.raises(ValueError):
+        streamly.LayoutProfiles().save()
+
+
+def test_tally():
+    tally = streamly.Tally(b"\r\n")
+    tally.update(b"a,b\r")
+    tally.update(b"\nc,d\r\ne", 0, 5)
+    assert tally.length == 9
+    assert tally.rows == 1
+    tally.update(b"\n")
+    assert tally.rows == 2
+    tally = streamly.Tally()
+    tally.update(b"a,b\n", 1)
+    assert tally.length == 3
+    assert tally.rows is None
+    tally = streamly.Tally(hash_algorithms=("md5",))
+    tally.update_hashes(b"a,b\n")
+    assert not tally.digests
+    tally.finalise()
+    assert tally.digests == {"md5": hashlib.md5(b"a,b\n").hexdigest()}
+
+
+@pytest.mark.parametrize("threaded", (False, True))
+def test_tee(threaded):
+    raw_stream = _general_byte_stream()
+    wrapped_stream = streamly.Streamly(raw_stream, header_row_identifier=b"Report Fields:\n",
+                                       footer_identifier=b"Grand")
+    file_sink = io.BytesIO()
+    chunks = []
+    total_length = streamly.tee(wrapped_stream, file_sink, chunks.append, size=10, threaded=threaded, max_pending=1)
+    assert total_length == len(_data_body)
+    assert file_sink.getvalue() == _data_body
+    assert b"".join(chunks) == _data_body
+
+    with pytest.raises(ValueError):
+        streamly.tee(wrapped_stream)
+
+
+@pytest.mark.parametrize("threaded", (False, True))
+def test_tee_sink_exception(threaded):
+    def failing_sink(data):
+        raise RuntimeError("sink failed")
+
+    wrapped_stream = streamly.Streamly(_general_byte_stream())
+    with pytest.raises(RuntimeError):
+        streamly.tee(wrapped_stream, io.BytesIO(), failing_sink, size=10, threaded=threaded, max_pending=1)
+
+
+@pytest.mark.parametrize("max_length, max_rows, repeat_header_row, compress, expected_rows", (
+    (None, 3, False, False, [3, 3, 3]),
+    (40, None, False, False, [2, 2, 2, 2, 1]),
+    (None, 4, True, False, [4, 4]),
+    (60, 2, True, True, [2, 2, 2, 2]),
+    (5, None, False, False, [1] * 9),
+))
+def test_write_parts(tmpdir, max_length, max_rows, repeat_header_row, compress, expected_rows):
+    wrapped_stream = streamly.Streamly(_general_byte_stream(), header_row_identifier=b"Report Fields:\n",
+                                       footer_identifier=b"Grand")
+    path_format = os.path.join(str(tmpdir), "part-{index:02d}.csv")
+    manifest = streamly.write_parts(wrapped_stream, path_format, max_length=max_length, max_rows=max_rows,
+                                    repeat_header_row=repeat_header_row, compress=compress, size=7)
+    assert [part["rows"] for part in manifest] == expected_rows
+    header_row = _data_body[:_data_body.find(b"\n") + 1]
+    output = b""
+    for index, part in enumerate(manifest):
+        assert part["path"] == path_format.format(index=index) + (".gz" if compress else "")
+        opener = gzip.open if compress else open
+        with opener(part["path"], "rb") as fp:
+            data = fp.read()
+        assert len(data) == part["length"]
+        if compress:
+            assert part["compressed_length"] == os.path.getsize(part["path"])
+        if repeat_header_row:
+            assert data.startswith(header_row)
+            data = data[len(header_row):]
+        assert part["offset"] == len(output) + (len(header_row) if repeat_header_row else 0)
+        if max_length is not None and part["rows"] > 1:
+            assert part["length"] <= max_length
+        output += data
+    assert (header_row + output if repeat_header_row else output) == _data_body
+
+    with pytest.raises(ValueError):
+        streamly.write_parts(wrapped_stream, path_format)
+
+
+@pytest.mark.parametrize("streamly_kwargs", ({"retain_first_header_row": False}, {"header_row_identifier": None}))
+def test_write_parts_repeat_header_row_not_retained(tmpdir, streamly_kwargs):
+    wrapped_stream = streamly.Streamly(io.BytesIO(b"a,b\n1,2\n3,4\n"), **streamly_kwargs)
+    path_format = os.path.join(str(tmpdir), "part-{index:02d}.csv")
+    with pytest.raises(ValueError):
+        streamly.write_parts(wrapped_stream, path_format, max_rows=1, repeat_header_row=True)
+    assert not os.listdir(str(tmpdir))
+
+
 class TestStreamly(object):
     def test_current_stream(self):
         raw_stream = _general_byte_stream()
@@ -140,6 +334,23 @@ class TestStreamly(object):
         assert part1 == expected_part1
         assert part2 == expected_part2
 
+    @pytest.mark.parametrize("size", (3, 8192))
+    def test__check_layout_footer_later_than_actual(self, size):
+        learned_data = b"a,b\nc,d\nTOTAL,1\n"
+        data = b"a,b\ne,f\nTOTAL,1\nextra\nmore\n"
+        layout_profiles = streamly.LayoutProfiles()
+
+        def read_all(raw_data):
+            wrapped_stream = streamly.Streamly(streamly.Stream(io.BytesIO(raw_data), len(raw_data)),
+                                               footer_identifier=b"TOTAL", layout_profiles=layout_profiles,
+                                               layout_key="report")
+            return _read_all(wrapped_stream, size)
+
+        assert read_all(learned_data) == b"a,b\nc,d\n"
+        assert layout_profiles.get("report")["footer_offset_from_end"] == 8
+        assert read_all(data) == b"a,b\ne,f\n"
+        assert layout_profiles.get("report")["footer_offset_from_end"] == 19
+
     def test__end_stream(self):
         raw_stream = _general_byte_stream()
         wrapped_stream = streamly.Streamly(raw_stream)
@@ -257,6 +468,105 @@ class TestStreamly(object):
         assert not end_of_prev
         assert data == _general_test_data
 
+    # Seekable streams are read rather than seeked when counting rows
+    @pytest.mark.parametrize("stream_factory", (_general_byte_stream, lambda: _NonSeekableStream(_general_test_data)))
+    @pytest.mark.parametrize("size", (3, 8192))
+    @pytest.mark.parametrize("header_row_offset", (_general_test_data.find(b"Report Fields:\n") + 5,
+                                                   len(_general_test_data) + 10))
+    def test__seek_layout_header_later_than_actual(self, stream_factory, size, header_row_offset):
+        header_row_identifier = b"Report Fields:\n"
+        layout_profiles = streamly.LayoutProfiles()
+        layout_profiles.update("report", header_row_offset=header_row_offset)
+        wrapped_stream = streamly.Streamly(stream_factory(), header_row_identifier=header_row_identifier,
+                                           footer_identifier=b"Grand", count_rows=True, layout_profiles=layout_profiles,
+                                           layout_key="report")
+        assert _read_all(wrapped_stream, size) == _data_body
+        header_row_identifier_offset = _general_test_data.find(header_row_identifier)
+        assert wrapped_stream.streams[0]["header_row_identifier_offset"] == header_row_identifier_offset
+        assert layout_profiles.get("report")["header_row_offset"] == header_row_identifier_offset
+        assert wrapped_stream.tallies["header"].length == header_row_identifier_offset + len(header_row_identifier)
+        assert wrapped_stream.tallies["header"].rows == 7
+
+    @pytest.mark.parametrize("header_row_offset_delta", (0, 1, -1))
+    def test__seek_layout_header_large_preamble(self, header_row_offset_delta):
+        # The identifier spans two of the chunks the preamble is streamed in
+        preamble = b"x" * (65536 - 5)
+        raw_data = preamble + b"Report Fields:\n" + _data_body
+        layout_profiles = streamly.LayoutProfiles()
+        layout_profiles.update("report", header_row_offset=len(preamble) + header_row_offset_delta)
+        wrapped_stream = streamly.Streamly(_NonSeekableStream(raw_data), header_row_identifier=b"Report Fields:\n",
+                                           layout_profiles=layout_profiles, layout_key="report")
+        assert _read_all(wrapped_stream, 8192) == _data_body
+        assert wrapped_stream.streams[0]["header_row_identifier_offset"] == len(preamble)
+        assert wrapped_stream.tallies["header"].length == len(preamble) + len(b"Report Fields:\n")
+
+    @pytest.mark.parametrize("stream_factory", (_general_byte_stream, lambda: _NonSeekableStream(_general_test_data)))
+    @pytest.mark.parametrize("size", (3, 10, 8192))
+    @pytest.mark.parametrize("retain_first_header_row", (True, False))
+    @pytest.mark.parametrize("header_row_position", (
+        {"header_row_offset": _general_test_data.find(b"col1")},
+        {"header_row_line": 7}
+    ))
+    def test__skip_preamble(self, stream_factory, size, retain_first_header_row, header_row_position):
+        wrapped_stream = streamly.Streamly(stream_factory(), stream_factory(), footer_identifier=b"Grand",
+                                           retain_first_header_row=retain_first_header_row, **header_row_position)
+        first_body = _data_body if retain_first_header_row else _data_body[_data_body.find(b"START"):]
+        assert _read_all(wrapped_stream, size) == first_body + _data_body[_data_body.find(b"START"):]
+
+    def test__skip_preamble_counted(self):
+        wrapped_stream = streamly.Streamly(_general_byte_stream(), header_row_offset=_general_test_data.find(b"col1"),
+                                           count_rows=True)
+        assert _read_all(wrapped_stream, 10) == _general_test_data[_general_test_data.find(b"col1"):]
+        assert wrapped_stream.tallies["header"].rows == 7
+        assert wrapped_stream.tallies["header"].length == _general_test_data.find(b"col1")
+
+        wrapped_stream = streamly.Streamly(_general_byte_stream(), header_row_line=7, header_row_end_identifier=b"s:\n",
+                                           count_rows=True)
+        assert not _read_all(wrapped_stream, 10)
+
+        with pytest.raises(ValueError):
+            streamly.Streamly(_general_byte_stream(), header_row_offset=1, header_row_line=1)
+
+    @pytest.mark.parametrize("binary, hash_in_thread", ((True, False), (True, True), (False, False)))
+    def test__tally(self, binary, hash_in_thread):
+        test_data = _general_test_data if binary else _general_test_data.decode("utf8")
+        data_body = _data_body if binary else _data_body.decode("utf8")
+        header_row_identifier = b"Report Fields:\n" if binary else "Report Fields:\n"
+        footer_identifier = b"Grand" if binary else "Grand"
+        stream_class = io.BytesIO if binary else io.StringIO
+        wrapped_stream = streamly.Streamly(stream_class(test_data), stream_class(test_data), binary=binary,
+                                           header_row_identifier=header_row_identifier,
+                                           footer_identifier=footer_identifier, count_rows=True,
+                                           hash_algorithms=("md5", "sha256"), hash_in_thread=hash_in_thread)
+        output = wrapped_stream.read(7)
+        data = wrapped_stream.read(7)
+        while data:
+            assert not wrapped_stream.tallies["cleaned"].digests
+            output += data
+            data = wrapped_stream.read(7)
+        assert wrapped_stream.end_reached
+        second_body = data_body[data_body.find(data_body[-1]) + 1:]
+        assert output == data_body + second_body
+        encoded_output = output if binary else output.encode("utf8")
+
+        cleaned = wrapped_stream.tallies["cleaned"]
+        assert cleaned.length == len(output)
+        assert cleaned.rows == 17
+        assert cleaned.digests == {"md5": hashlib.md5(encoded_output).hexdigest(),
+                                   "sha256": hashlib.sha256(encoded_output).hexdigest()}
+        first_cleaned = wrapped_stream.streams[0]["tallies"]["cleaned"]
+        assert first_cleaned.length == len(data_body)
+        assert first_cleaned.rows == 9
+        assert first_cleaned.digests["md5"] == hashlib.md5(_data_body).hexdigest()
+
+        header = wrapped_stream.streams[0]["tallies"]["header"]
+        assert header.length == test_data.find(header_row_identifier) + len(header_row_identifier)
+        assert header.rows == 7
+        assert wrapped_stream.streams[1]["tallies"]["header"].length == header.length + len(data_body) - len(second_body)
+        footer = wrapped_stream.streams[0]["tallies"]["footer"]
+        assert footer.length <= len(test_data) - test_data.find(footer_identifier)
+        assert wrapped_stream.tallies["footer"].length >= 2 * len(footer_identifier)
+
     def test_read(self):
         test_data_length = len(_general_test_data)
 
@@ -310,3 +620,109 @@ class TestStreamly(object):
             print(data)
             data = wrapped_stream.read(10)
         assert output == _data_body
+
+    @pytest.mark.parametrize("size", (1, 20, 8192))
+    def test_iter_batches(self, size):
+        pytest.importorskip("numpy")
+        wrapped_stream = streamly.Streamly(_general_byte_stream(), header_row_identifier=b"Report Fields:\n",
+                                           footer_identifier=b"Grand")
+        rows = []
+        fields = []
+        for batch in wrapped_stream.iter_batches(size, delimiter=b","):
+            assert len(batch.row_starts) == len(batch.row_ends)
+            rows.extend(batch.data[start:end] for start, end in zip(batch.row_starts, batch.row_ends))
+            fields.extend(batch.data[start:end] for start, end in zip(batch.field_starts, batch.field_ends))
+        expected_rows = _data_body[:-1].split(b"\n")
+        assert rows == expected_rows
+        assert fields == [field for row in expected_rows for field in row.split(b",")]
+
+    def test_iter_batches_unterminated(self):
+        pytest.importorskip("numpy")
+        wrapped_stream = streamly.Streamly(io.BytesIO(b"a,b\r\nc,d\r\ne,f"), header_row_end_identifier=b"\r\n")
+        batch, final_batch = wrapped_stream.iter_batches()
+        assert list(batch.row_starts) == [0, 5]
+        assert list(batch.row_ends) == [3, 8]
+        assert batch.field_starts is None
+        assert final_batch.data == b"e,f"
+        assert list(final_batch.row_starts) == [0]
+        assert list(final_batch.row_ends) == [3]
+
+        wrapped_stream = streamly.Streamly(_general_text_stream(), binary=False)
+        with pytest.raises(ValueError):
+            next(wrapped_stream.iter_batches())
+
+    def test_iter_batches_self_overlapping_identifier(self):
+        pytest.importorskip("numpy")
+        wrapped_stream = streamly.Streamly(io.BytesIO(b"a\n\n\nb\n\n"), header_row_end_identifier=b"\n\n")
+        batch, = wrapped_stream.iter_batches()
+        assert list(batch.row_starts) == [0, 3]
+        assert list(batch.row_ends) == [1, 5]
+        assert [batch.data[start:end] for start, end in zip(batch.row_starts, batch.row_ends)] == [b"a", b"\nb"]
+
+    @pytest.mark.parametrize("stream_factory", (_general_byte_stream, lambda: _NonSeekableStream(_general_test_data)))
+    @pytest.mark.parametrize("size", (3, 8192))
+    def test_read_layout_profiles(self, tmpdir, stream_factory, size):
+        path = os.path.join(str(tmpdir), "profiles.json")
+        header_row_identifier = b"Report Fields:\n"
+        footer_identifier = b"Grand"
+        stream_length = len(_general_test_data)
+        expected_output = _data_body + _data_body[_data_body.find(b"START"):]
+        logger = logging.getLogger("streamly")
+        mock_handler = MockLoggingHandler()
+        logger.addHandler(mock_handler)
+        logger.setLevel(logging.DEBUG)
+
+        def read_all(layout_profiles):
+            wrapped_stream = streamly.Streamly(streamly.Stream(stream_factory(), stream_length),
+                                               streamly.Stream(stream_factory(), stream_length),
+                                               header_row_identifier=header_row_identifier,
+                                               footer_identifier=footer_identifier, layout_profiles=layout_profiles,
+                                               layout_key="report")
+            return _read_all(wrapped_stream, size)
+
+        # The footer is only peeked at if it has not already been read
+        seekable = stream_factory is _general_byte_stream and size < stream_length
+        header_message = "Header row identifier found at profiled offset."
+        footer_message = "Footer found at profiled offset."
+
+        # learn from the first stream, which is used for the second
+        layout_profiles = streamly.LayoutProfiles(path)
+        assert read_all(layout_profiles) == expected_output
+        assert mock_handler.messages["DEBUG"].count(header_message) == 1
+        assert mock_handler.messages["DEBUG"].count(footer_message) == (1 if seekable else 0)
+        layout_profiles.save()
+        layout_profiles = streamly.LayoutProfiles(path)
+        assert layout_profiles.get("report") == {
+            "header_row_offset": _general_test_data.find(header_row_identifier),
+            "footer_offset_from_end": stream_length - _general_test_data.find(footer_identifier)
+        }
+
+        # use
+        mock_handler.reset()
+        assert read_all(layout_profiles) == expected_output
+        assert mock_handler.messages["DEBUG"].count(header_message) == 2
+        assert mock_handler.messages["DEBUG"].count(footer_message) == (2 if seekable else 0)
+
+        # fall back when the footer is predicted too early
+        mock_handler.reset()
+        layout_profiles.update("report", header_row_offset=3,
+                               footer_offset_from_end=stream_length - _general_test_data.find(footer_identifier) + 10)
+        assert read_all(layout_profiles) == expected_output
+        assert mock_handler.messages["DEBUG"].count(header_message) == 1
+        assert mock_handler.messages["DEBUG"].count(footer_message) == (1 if seekable else 0)
+        logger.removeHandler(mock_handler)
+
+        with pytest.raises(ValueError):
+            streamly.Streamly(_general_byte_stream(), layout_key="report")
+
+    @pytest.mark.parametrize("size", (1, 7, 8192))
+    def test_read_rows(self, size):
+        wrapped_stream = streamly.Streamly(_general_byte_stream(), header_row_identifier=b"Report Fields:\n",
+                                           header_row_end_identifier=b",baz\n", footer_identifier=b"Grand")
+        chunks = []
+        data = wrapped_stream.read_rows(size)
+        while data:
+            chunks.append(data)
+            data = wrapped_stream.read_rows(size)
+        assert b"".join(chunks) == _data_body
+        assert all(chunk.endswith(b",baz\n") for chunk in chunks)